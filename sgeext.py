@@ -12,17 +12,73 @@ import logging
 import os
 import re
 
-from shutil import copyfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from shutil import copyfile, copyfileobj
 from subprocess import check_output, CalledProcessError, DEVNULL
-from typing import List, Optional
+from typing import AbstractSet, Callable, Dict, FrozenSet, List, Optional
 
 import requests
 
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as URLLib3HTTPError
+from urllib3.util.retry import Retry
+
+
+# Module logger (configured in `main`, through the root one).
+LOGGER = logging.getLogger("sgeext")
 
 # Emojis and "regular" images are served by GitHub here.
 GITHUB_ASSETS_BASE_URL = "https://github.githubassets.com/images/icons/emoji/{}.png"
 # The emojis database from the gemoji project is hosted here.
 EMOJI_DB_URL = "https://github.com/github/gemoji/raw/master/db/emoji.json"
+# The remote emojis database is cached (along with its `ETag`) under this directory.
+EMOJI_DB_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "sgeext",
+)
+# Maximum number of concurrent downloads (we are mostly waiting on the network anyway).
+MAX_WORKERS = 32
+# Local gemoji gem installations are located thanks to this regular expression.
+# Usually `/var/lib/gems/X.Y.Z/gems/gemoji-T.U.V/lib/gemoji.rb` on GNU/Linux.
+# Please check <https://github.com/github/gemoji> project structure.
+ESCAPED_PATH_SEP = re.escape(os.sep)
+GEMOJI_GEM_PATH_RE = re.compile(
+    rf"^(.+?{ESCAPED_PATH_SEP}gemoji-.+?{ESCAPED_PATH_SEP})lib{ESCAPED_PATH_SEP}gemoji\.rb$"
+)
+
+# (connect, read) timeouts, in seconds, applied to each HTTP request.
+REQUESTS_TIMEOUT = (3.05, 30)
+
+# A single HTTP session is shared across downloads, so TCP/TLS connections are kept alive.
+SESSION = requests.Session()
+
+
+def mount_http_adapter(pool_size: int = MAX_WORKERS):
+    """
+    (Re-)mount on `SESSION` an HTTP adapter keeping up to `pool_size` connections alive per host.
+    As (almost) every request targets the same host, concurrent downloads wait for a pooled
+    connection to be released instead of opening (and then discarding) an extra one.
+    """
+    # Release the connections pooled by the adapter we are about to replace (if any).
+    previous_adapter = SESSION.adapters.get("https://")
+    if previous_adapter is not None:
+        previous_adapter.close()
+
+    SESSION.mount(
+        "https://",
+        HTTPAdapter(
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=(429, 500, 502, 503, 504),
+                # Let `download_file` handle the last (erroneous) response by itself.
+                raise_on_status=False,
+            ),
+        ),
+    )
 
 
 def open_and_load_emojis_db(file_path: str) -> List[dict]:
@@ -33,48 +89,72 @@ def open_and_load_emojis_db(file_path: str) -> List[dict]:
 
     except (FileNotFoundError, json.JSONDecodeError) as error:
         emojis_db = []
-        logging.error("Could not read or load the emojis database : %s.", error)
+        LOGGER.error("Could not read or load the emojis database : %s.", error)
 
     return emojis_db
 
 
-def download_file(url: str, path: str = None, force: bool = False, real_name: str = None) -> bool:
+def list_existing_files(path: str) -> FrozenSet[str]:
+    """Return the names of the files already present under `path` (or an empty set)"""
+    try:
+        with os.scandir(path) as entries:
+            return frozenset(entry.name for entry in entries if entry.is_file())
+    except FileNotFoundError:
+        return frozenset()
+
+
+def download_file(
+    url: str,
+    path: str = None,
+    existing_files: AbstractSet[str] = frozenset(),
+    real_name: str = None,
+) -> bool:
     """
     Download a file specified by `url` and save it locally under `path`.
-    Normalize path and / or create non-existing directory structure.
+    Normalize path (its directory structure is expected to exist already).
+    Files whose name belong to `existing_files` (see `list_existing_files`) are skipped.
     Returns `True` on success, and `False` on error.
     See <https://stackoverflow.com/a/16696317/10599709>
     """
     if not path:
         path = os.getcwd()
-    elif not os.path.exists(path):
-        os.makedirs(path, mode=0o755)
 
     # Save this entity under the specified name, or directly its remote name.
-    if real_name:
-        file_name = os.path.join(path, real_name + ".png")
-    else:
-        file_name = os.path.join(path, url.split("/")[-1])
+    base_name = real_name + ".png" if real_name else url.split("/")[-1]
+    file_name = os.path.join(path, base_name)
+    part_file_name = file_name + ".part"
 
-    if not force and os.path.exists(file_name):
+    if base_name in existing_files:
         # This file already exists, skip it when running non-force mode.
-        logging.info("The file %s already exists, run `-f` to download it again.", file_name)
+        LOGGER.info("The file %s already exists, run `-f` to download it again.", file_name)
         return True
 
-    logging.info("Downloading <%s> to %s", url, file_name)
-
-    with requests.get(url, stream=True) as get_request:
-        if get_request.status_code != 200:
-            # This URL does not exist ; Don't try to download a thing !
-            logging.warning("The URL above does not exist, can't download.")
-            return False
-
-        with open(file_name, "wb") as f_image:
-            for chunk in get_request.iter_content(chunk_size=8192):
-                if chunk:
-                    f_image.write(chunk)
+    LOGGER.info("Downloading <%s> to %s", url, file_name)
 
-            f_image.flush()
+    try:
+        with SESSION.get(url, stream=True, timeout=REQUESTS_TIMEOUT) as get_request:
+            if get_request.status_code != 200:
+                # This URL does not exist ; Don't try to download a thing !
+                LOGGER.warning("The URL <%s> does not exist, can't download.", url)
+                return False
+
+            # Transparently decompress the payload (if any `Content-Encoding` was negotiated).
+            get_request.raw.decode_content = True
+            with open(part_file_name, "wb") as f_image:
+                copyfileobj(get_request.raw, f_image, length=64 * 1024)
+
+        # Only expose complete files, so a failed download won't be skipped on next runs.
+        os.replace(part_file_name, file_name)
+
+    # Reading `raw` directly bypasses `requests` wrapping of `urllib3` (mid-stream) exceptions.
+    except (requests.RequestException, URLLib3HTTPError, OSError) as error:
+        # Don't abort the whole extraction because of a single (network) failure.
+        LOGGER.warning("Could not download <%s> to %s : %s.", url, file_name, error)
+        try:
+            os.remove(part_file_name)
+        except FileNotFoundError:
+            pass
+        return False
 
     return True
 
@@ -90,28 +170,75 @@ def localize_emoji_install() -> Optional[str]:
         ).strip()
     except (FileNotFoundError, CalledProcessError) as error:
         # Local gem not available ? Not an issue, we will figure something out.
-        logging.info("Localization of the gemoji gem installation failed : %s.", error)
+        LOGGER.info("Localization of the gemoji gem installation failed : %s.", error)
         return None
 
     # Now, try to extract its grand-parent location.
-    # Usually `/var/lib/gems/X.Y.Z/gems/gemoji-T.U.V/lib/gemoji.rb` on GNU/Linux.
-    # Please check <https://github.com/github/gemoji> project structure.
-    escaped_path_sep = re.escape(os.sep)
-    gemoji_local_path = re.fullmatch(
-        rf"^(.+?{escaped_path_sep}gemoji-.+?{escaped_path_sep})lib{escaped_path_sep}gemoji\.rb$",
-        gem_wich_gemoji_output,
-    )
+    gemoji_local_path = GEMOJI_GEM_PATH_RE.fullmatch(gem_wich_gemoji_output)
     if gemoji_local_path is None:
-        logging.info(
+        LOGGER.info(
             "gemoji looks installed on your system, but couldn't locate it precisely."
             " Please open an issue on the project repository."
         )
         return None
 
-    logging.info("Found gemoji gem installation folder : %s", gemoji_local_path.group(1))
+    LOGGER.info("Found gemoji gem installation folder : %s", gemoji_local_path.group(1))
     return gemoji_local_path.group(1)
 
 
+def update_emojis_db_cache(cache_file: str) -> List[dict]:
+    """
+    Download and load the remote emojis database, unless `cache_file` did not change since.
+    Returns the downloaded database (also cached, if possible), or the cached one if up to date.
+    Its `ETag` is stored aside (`cache_file` + ".etag") to revalidate it on next runs.
+    """
+    etag_file = cache_file + ".etag"
+
+    # Only revalidate a cached database we are actually able to load.
+    cached_emojis_db = []
+    headers = {}
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, mode="rb") as f_emojis_db:
+                cached_emojis_db = json.load(f_emojis_db)
+            with open(etag_file, encoding="utf-8") as f_etag:
+                etag = f_etag.read().strip()
+        except (OSError, json.JSONDecodeError) as error:
+            LOGGER.info("Ignoring the cached emojis database : %s.", error)
+        else:
+            if cached_emojis_db:
+                headers["If-None-Match"] = etag
+
+    LOGGER.info("Downloading <%s>", EMOJI_DB_URL)
+
+    # Don't stream this one, so `requests` transparently decompresses the (gzip'd) payload.
+    get_request = SESSION.get(EMOJI_DB_URL, headers=headers, timeout=REQUESTS_TIMEOUT)
+    if get_request.status_code == 304:
+        LOGGER.info("The cached emojis database (%s) is up to date.", cache_file)
+        return cached_emojis_db
+
+    get_request.raise_for_status()
+    emojis_db = get_request.json()
+
+    # The database is already loaded, caching it is only a bonus for subsequent runs.
+    try:
+        # Drop the (now stale) `ETag` first, so an interrupted write won't be considered fresh.
+        os.makedirs(os.path.dirname(cache_file), mode=0o755, exist_ok=True)
+        if os.path.exists(etag_file):
+            os.remove(etag_file)
+
+        with open(cache_file, "wb") as f_emojis_db:
+            f_emojis_db.write(get_request.content)
+
+        if "ETag" in get_request.headers:
+            with open(etag_file, "w", encoding="utf-8") as f_etag:
+                f_etag.write(get_request.headers["ETag"])
+    except OSError as error:
+        LOGGER.warning("Could not cache the emojis database : %s.", error)
+
+    return emojis_db
+
+
 def retrieve_emoji_db(gemoji_local_path: str = None) -> List[dict]:
     """
     This function tries anyhow to open and load an emoji database.
@@ -121,113 +248,219 @@ def retrieve_emoji_db(gemoji_local_path: str = None) -> List[dict]:
     if gemoji_local_path:
         return open_and_load_emojis_db(os.path.join(gemoji_local_path + "db", "emoji.json"))
 
-    # If we don't have it locally, just temporarily fetch it from the GitHub project.
-    download_file(EMOJI_DB_URL)
-    emojis_db_local_file = os.path.join(os.getcwd(), "emoji.json")
-    emojis_db = open_and_load_emojis_db(emojis_db_local_file)
-    os.remove(emojis_db_local_file)
-    logging.info("The temporarily emojis database (%s) has been removed.", emojis_db_local_file)
-
-    return emojis_db
+    # If we don't have it locally, fetch it from the GitHub project (unless our copy is fresh).
+    emojis_db_cache_file = os.path.join(EMOJI_DB_CACHE_DIR, "emoji.json")
+    try:
+        return update_emojis_db_cache(emojis_db_cache_file)
+    except requests.RequestException as error:
+        # Network issue ? Let's fall back on the cached copy (if any).
+        LOGGER.warning("Could not download the emojis database : %s.", error)
 
+    return open_and_load_emojis_db(emojis_db_cache_file)
 
-def handle_emoji_extraction(
-    emoji: dict, first_alias: str, path: str, force: bool, real_names: bool
-):
-    """Simple function reduce `perform_emojis_extraction` cyclomatic complexity"""
 
+def compute_unicode_code(emoji: str) -> str:
+    """Return the (GitHub flavored) hexadecimal Unicode value of `emoji`"""
     # Extract emoji Unicode value, and format it as an hexadecimal string.
-    code = "".join(format(ord(char), "x") for char in emoji["emoji"])
+    code = "".join(format(ord(char), "x") for char in emoji)
 
     # Some emojis contain a "variation selector" at the end of their Unicode value.
     # VS-15 : U+FE0E || VS-16 : U+FE0F
-    code = re.sub(r"fe0[ef]$", "", code, re.IGNORECASE)
+    if code.endswith(("fe0e", "fe0f")):
+        code = code[:-4]
 
     # For "shrugging" emojis only (`1f937-*`), we have to replace `200d` by a real hyphen.
-    code = re.sub(r"^(1f937)(?:200d)(.*)$", r"\1-\2", code, re.IGNORECASE)
+    if code.startswith("1f937200d"):
+        code = "1f937-" + code[9:]
 
     # For "flags" emojis only (`1f1??1f1??`), we have to add an extra hyphen...
-    code = re.sub(r"^(1f1)(..)(1f1)(..)$", r"\1\2-\3\4", code, re.IGNORECASE)
+    if len(code) == 10 and code.startswith("1f1") and code[5:8] == "1f1":
+        code = code[:5] + "-" + code[5:]
+
+    return code
 
-    logging.info("Inferred %s Unicode value for %s", code, first_alias)
 
-    return download_file(
+def handle_emoji_extraction(
+    emoji: dict, first_alias: str, path: str, existing_files: AbstractSet[str], real_names: bool
+) -> Callable[[], bool]:
+    """Build (without running it) the task downloading this "real" emoji, and return it"""
+
+    code = compute_unicode_code(emoji["emoji"])
+    LOGGER.info("Inferred %s Unicode value for %s", code, first_alias)
+
+    return partial(
+        download_file,
         url=GITHUB_ASSETS_BASE_URL.format("unicode/" + code),
         path=os.path.join(path, "unicode"),
-        force=force,
+        existing_files=existing_files,
         real_name=(first_alias if real_names else None),
     )
 
 
-def handle_github_emojis(
-    first_alias: str, path: str, force: bool, gemoji_local_path: str = None
+def copy_local_file(
+    image_name: str, path: str, gemoji_local_path: str, existing_files: AbstractSet[str]
 ) -> bool:
-    """Simple function reducing `perform_emojis_extraction` cyclomatic complexity"""
-    if not gemoji_local_path:
-        # I told you it was not an issue, let's download it as well !
-        return download_file(url=GITHUB_ASSETS_BASE_URL.format(first_alias), path=path, force=force)
-
-    # We already have it locally somewhere, just copy it...
-    image_name = first_alias + ".png"
+    """Copy `image_name` from the local gemoji gem installation to `path`"""
     image_local_path = os.path.join(path, image_name)
-    if not force and os.path.exists(image_local_path):
+    if image_name in existing_files:
         # This file already exists, skip it when running non-force mode.
-        logging.info("The file %s already exists, run `-f` to copy it again.", image_local_path)
+        LOGGER.info("The file %s already exists, run `-f` to copy it again.", image_local_path)
     else:
-        logging.info("Copying %s from your local system.", image_local_path)
-        copyfile(os.path.join(gemoji_local_path, "images", image_name), image_local_path)
+        LOGGER.info("Copying %s from your local system.", image_local_path)
+        try:
+            copyfile(
+                os.path.join(gemoji_local_path, "images", image_name), image_local_path + ".part"
+            )
+            os.replace(image_local_path + ".part", image_local_path)
+        except OSError as error:
+            LOGGER.warning("Could not copy %s : %s.", image_local_path, error)
+            try:
+                os.remove(image_local_path + ".part")
+            except FileNotFoundError:
+                pass
+            return False
 
     return True
 
 
-def perform_emojis_extraction(
-    path: str, force: bool, subset: List[str], real_names: bool, only_real_emojis: bool
+def handle_github_emojis(
+    first_alias: str,
+    path: str,
+    existing_files: AbstractSet[str],
+    gemoji_local_path: str = None,
+) -> Callable[[], bool]:
+    """Build (without running it) the task downloading or copying this GitHub "fake" emoji"""
+    if not gemoji_local_path:
+        # I told you it was not an issue, let's download it as well !
+        return partial(
+            download_file,
+            url=GITHUB_ASSETS_BASE_URL.format(first_alias),
+            path=path,
+            existing_files=existing_files,
+        )
+
+    # We already have it locally somewhere, just copy it...
+    return partial(copy_local_file, first_alias + ".png", path, gemoji_local_path, existing_files)
+
+
+def index_emojis_aliases(emojis_db: List[dict], names: AbstractSet[str]) -> Dict[str, dict]:
+    """
+    Map each of `names` to the emoji (from `emojis_db`) it is an alias of.
+    Unknown names are left out, and iteration stops as soon as every name has been found.
+    """
+    alias_to_emoji = {}
+    remaining_names = set(names)
+    for emoji in emojis_db:
+        match_names = remaining_names.intersection(emoji["aliases"])
+        if not match_names:
+            continue
+
+        alias_to_emoji.update(dict.fromkeys(match_names, emoji))
+        remaining_names -= match_names
+        if not remaining_names:
+            # We reached the end of the user-supplied elements. We may stop the iteration.
+            break
+
+    return alias_to_emoji
+
+
+def perform_emojis_extraction(  # pylint: disable=too-many-arguments,too-many-locals
+    path: str,
+    force: bool,
+    subset: List[str],
+    real_names: bool,
+    only_real_emojis: bool,
+    *,
+    max_workers: int = MAX_WORKERS,
 ):
     """
     Effectively perform the emojis extraction.
     By default, run extraction on the whole set.
     The `subset` parameter allows the user to provide a specific list of emojis.
+    Downloads (and copies) are dispatched to a pool of `max_workers` threads.
     """
 
+    # Size the connections pool after the number of concurrent downloads.
+    mount_http_adapter(max_workers)
+
     gemoji_local_path = localize_emoji_install()
     emojis_db = retrieve_emoji_db(gemoji_local_path)
 
-    # Iterate over the elements, looking for "real" emojis and "regular" images.
+    if subset:
+        # Duplicated user-supplied names are only considered once.
+        subset_names = set(subset)
+
+        # Index emojis by their aliases, so that user-supplied names may be looked up directly.
+        # This allows us to "find" emojis whose user-supplied name is an alternative.
+        # For instance : Match `bow`, even if its "official" name is `bowing_man`.
+        alias_to_emoji = index_emojis_aliases(emojis_db, subset_names)
+
+        # Different names may refer to the same emoji (`uk` and `gb`), only extract it once.
+        emojis_db = list(
+            {
+                alias_to_emoji[name]["aliases"][0]: alias_to_emoji[name]
+                for name in subset
+                if name in alias_to_emoji
+            }.values()
+        )
+
+        # Report the elements that have not been found (in the order they have been supplied)...
+        unmatched = [name for name in dict.fromkeys(subset) if name not in alias_to_emoji]
+        if unmatched:
+            LOGGER.warning(
+                "The following emojis have not been found : %s", "', '".join(unmatched)
+            )
+
+    # Unless forced, list once the files already extracted, so they can be skipped.
+    existing_files: FrozenSet[str] = frozenset()
+    existing_unicode_files: FrozenSet[str] = frozenset()
+    if not force:
+        existing_files = list_existing_files(path)
+        existing_unicode_files = list_existing_files(os.path.join(path, "unicode"))
+
+    # Partition the elements once, between "real" emojis and GitHub "fake" ones ("regular" images).
+    real_emojis = [emoji for emoji in emojis_db if "emoji" in emoji]
+    fake_emojis = [] if only_real_emojis else [emoji for emoji in emojis_db if "emoji" not in emoji]
+
+    # Create the (needed) directory structure once, before downloads run concurrently.
+    if real_emojis:
+        os.makedirs(os.path.join(path, "unicode"), mode=0o755, exist_ok=True)
+    if fake_emojis:
+        os.makedirs(path, mode=0o755, exist_ok=True)
+
+    # The _first_ alias in the list is effectively used to compute its Unicode value.
+    tasks = [
+        handle_emoji_extraction(
+            emoji, emoji["aliases"][0], path, existing_unicode_files, real_names
+        )
+        for emoji in real_emojis
+    ]
+    tasks += [
+        handle_github_emojis(emoji["aliases"][0], path, existing_files, gemoji_local_path)
+        for emoji in fake_emojis
+    ]
+
+    # Now, effectively download (or copy) the files concurrently, as we are mostly I/O bound.
     i = 0
-    for emoji in emojis_db:
-        if subset:
-            # Intersect our `subset` names with this emoji's aliases !
-            # This allows us to "find" emojis whose user-supplied name is an alternative.
-            # For instance : Match `bow`, even if its "official" name is `bowing_man`.
-            match_names = set(emoji["aliases"]) & set(subset)
-            if not match_names:
-                continue
-
-            # The _first_ alias in the list is effectively used to compute its Unicode value.
-            first_alias = emoji["aliases"][0]
-
-        if "emoji" in emoji:
-            if handle_emoji_extraction(emoji, first_alias, path, force, real_names):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in as_completed([executor.submit(task) for task in tasks]):
+            if future.result():
                 i += 1
 
-        elif not only_real_emojis:
-            # Those are GitHub "fake" emojis ("regular" images).
-            if handle_github_emojis(first_alias, path, force, gemoji_local_path):
-                i += 1
+    LOGGER.info("Successfully downloaded / copied %i emojis !", i)
 
-        if subset:
-            # The operations above _should_ be OK, we may remove these elements from the set.
-            for match_name in match_names:
-                subset.remove(match_name)
-            if not subset:
-                # We reached the end of the user-supplied elements. We may stop the iteration.
-                break
 
-    # At this moment, `subset` contains only the elements that have not been found...
-    if subset:
-        logging.warning("The following emojis have not been found : %s", "', '".join(subset))
+def positive_int(value: str) -> int:
+    """`argparse` type, only accepting (strictly) positive integers"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value!r} is not a positive integer")
 
-    logging.info("Successfully downloaded / copied %i emojis !", i)
+    return number
 
 
 def main():
@@ -249,6 +482,13 @@ def main():
         action="store_true",
         help="Force file download, even if they already exist",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=positive_int,
+        default=MAX_WORKERS,
+        help="Number of concurrent downloads",
+    )
     parser.add_argument(
         "-l",
         "--list",
@@ -294,7 +534,9 @@ def main():
     )
 
     # EXTRACT ALL-THE-THINGS !
-    perform_emojis_extraction(args.directory, args.force, args.list, args.names, args.only_emojis)
+    perform_emojis_extraction(
+        args.directory, args.force, args.list, args.names, args.only_emojis, max_workers=args.jobs
+    )
 
 
 if __name__ == "__main__":